@@ -1,15 +1,25 @@
 import os
+import sys
 import uvicorn
 import requests
 import yfinance as yf
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from groq import Groq
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from typing import List, Optional
+from collections import Counter, deque
+from contextlib import contextmanager
+import contextvars
 import json
+import random
 import re
+import secrets
+import threading
+import time
+import uuid
 
 # Load environment variables
 load_dotenv()
@@ -23,6 +33,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
 
 # Groq Client
@@ -92,31 +103,192 @@ class LeadResponse(BaseModel):
     conversion_probability: str
     recommended_action: str
 
+# ==================== REQUEST PROFILING ====================
+# Opt-in per request with the "X-Profile: 1" header ("X-Profile: cpu" also samples
+# the CPU stack), or randomly via PROFILE_SAMPLE_RATE. Recent traces are kept in
+# memory and served from /admin/traces when ADMIN_TOKEN is set.
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+PROFILE_CPU_INTERVAL = float(os.getenv("PROFILE_CPU_INTERVAL", "0.005"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_traces = deque(maxlen=PROFILE_BUFFER_SIZE)
+_traces_lock = threading.Lock()
+
+class Span:
+    """A timed section of a profiled request, with nested child spans"""
+
+    def __init__(self, name: str, attrs: Optional[dict] = None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+        self.children = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attrs": self.attrs,
+            "error": self.error,
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+    def folded(self, prefix: str = "") -> List[str]:
+        """Span self-times in microseconds, as collapsed stacks for flamegraph tools"""
+        path = f"{prefix};{self.name}" if prefix else self.name
+        self_time = self.duration - sum(child.duration for child in self.children)
+        lines = [f"{path} {max(0, int(self_time * 1e6))}"]
+        for child in self.children:
+            lines.extend(child.folded(path))
+        return lines
+
+class Trace:
+    """Span tree (and optional CPU samples) recorded for one request"""
+
+    def __init__(self, method: str, path: str, cpu: bool = False):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.timestamp = time.time()
+        self.method = method
+        self.path = path
+        self.status_code = None
+        self.root = Span(f"{method} {path}")
+        self.cpu_samples = Counter() if cpu else None
+
+    def summary(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "timestamp": self.timestamp,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "duration_ms": round(self.root.duration * 1000, 3),
+            "cpu_profile": self.cpu_samples is not None,
+        }
+
+    def to_dict(self) -> dict:
+        data = self.summary()
+        data["spans"] = self.root.to_dict(self.root.start)
+        if self.cpu_samples is not None:
+            data["cpu_interval_ms"] = PROFILE_CPU_INTERVAL * 1000
+            data["cpu_samples"] = dict(self.cpu_samples.most_common())
+        return data
+
+class CpuSampler(threading.Thread):
+    """Samples the stack of the thread serving a profiled request at a fixed interval"""
+
+    def __init__(self, thread_id: int, samples: Counter, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.samples = samples
+        self.interval = interval
+        self.halted = threading.Event()
+
+    def run(self):
+        while not self.halted.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.halted.set()
+        self.join()
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """Time a block as a child of the current span; no-op for unprofiled requests"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = Span(name, attrs)
+    parent.children.append(span)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.end = time.perf_counter()
+        _current_span.reset(token)
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    """Record a trace for requests opted in via X-Profile or PROFILE_SAMPLE_RATE"""
+    mode = request.headers.get("x-profile", "").strip().lower()
+    if request.url.path.startswith("/admin") or mode in ("0", "false", "off"):
+        return await call_next(request)
+    if not mode and random.random() >= PROFILE_SAMPLE_RATE:
+        return await call_next(request)
+
+    trace = Trace(request.method, request.url.path, cpu=(mode == "cpu"))
+    token = _current_span.set(trace.root)
+    sampler = None
+    if trace.cpu_samples is not None:
+        # Endpoints run their blocking calls on this thread, so sample it
+        sampler = CpuSampler(threading.get_ident(), trace.cpu_samples, PROFILE_CPU_INTERVAL)
+        sampler.start()
+    try:
+        response = await call_next(request)
+        trace.status_code = response.status_code
+    except Exception:
+        trace.status_code = 500
+        raise
+    finally:
+        if sampler:
+            sampler.stop()
+        trace.root.end = time.perf_counter()
+        _current_span.reset(token)
+        with _traces_lock:
+            _traces.append(trace)
+
+    response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
 # ==================== HELPER FUNCTIONS ====================
 
 def parse_json_response(response_text: str) -> dict:
     """Clean and parse JSON from LLM response"""
-    text = response_text.strip()
-    # Remove markdown code blocks if present
-    if text.startswith("```"):
-        text = re.sub(r'^```(?:json)?\s*', '', text)
-        text = re.sub(r'\s*```$', '', text)
-    # If still not valid JSON, try to extract JSON object from the text
-    if not text.startswith('{'):
-        json_match = re.search(r'\{[\s\S]*\}', text)
-        if json_match:
-            text = json_match.group(0)
-    return json.loads(text)
+    with trace_span("parse_json_response", chars=len(response_text)):
+        text = response_text.strip()
+        # Remove markdown code blocks if present
+        if text.startswith("```"):
+            text = re.sub(r'^```(?:json)?\s*', '', text)
+            text = re.sub(r'\s*```$', '', text)
+        # If still not valid JSON, try to extract JSON object from the text
+        if not text.startswith('{'):
+            json_match = re.search(r'\{[\s\S]*\}', text)
+            if json_match:
+                text = json_match.group(0)
+        return json.loads(text)
 
 def generate_with_groq(prompt: str, max_tokens: int = 2000) -> str:
     """Generate response using Groq LLaMA 3.3 70B"""
-    completion = client.chat.completions.create(
-        messages=[{"role": "user", "content": prompt}],
-        model="llama-3.3-70b-versatile",
-        temperature=0.7,
-        max_tokens=max_tokens,
-    )
-    return completion.choices[0].message.content.strip()
+    with trace_span("groq.chat_completion", model="llama-3.3-70b-versatile", max_tokens=max_tokens) as span:
+        completion = client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model="llama-3.3-70b-versatile",
+            temperature=0.7,
+            max_tokens=max_tokens,
+        )
+        if span is not None and getattr(completion, "usage", None):
+            span.attrs["prompt_tokens"] = completion.usage.prompt_tokens
+            span.attrs["completion_tokens"] = completion.usage.completion_tokens
+        return completion.choices[0].message.content.strip()
 
 # ==================== API ENDPOINTS ====================
 
@@ -136,7 +308,8 @@ async def generate_campaign(request: CampaignRequest):
     if not request.product_name.strip():
         raise HTTPException(status_code=400, detail="Product name is required")
     
-    prompt = f"""You are a senior marketing strategist with 15+ years experience in digital marketing.
+    with trace_span("build_prompt"):
+        prompt = f"""You are a senior marketing strategist with 15+ years experience in digital marketing.
 Create a comprehensive marketing campaign for the following:
 
 PRODUCT: {request.product_name}
@@ -168,14 +341,15 @@ IMPORTANT: Respond ONLY with valid JSON. No explanations outside the JSON."""
         response_text = generate_with_groq(prompt)
         result = parse_json_response(response_text)
         
-        return CampaignResponse(
-            product_name=request.product_name,
-            platform=request.platform,
-            campaign_objectives=result.get("campaign_objectives", []),
-            content_ideas=[ContentIdea(**idea) for idea in result.get("content_ideas", [])[:5]],
-            ad_copies=[AdCopy(**copy) for copy in result.get("ad_copies", [])[:3]],
-            cta_suggestions=result.get("cta_suggestions", [])
-        )
+        with trace_span("build_response", model="CampaignResponse"):
+            return CampaignResponse(
+                product_name=request.product_name,
+                platform=request.platform,
+                campaign_objectives=result.get("campaign_objectives", []),
+                content_ideas=[ContentIdea(**idea) for idea in result.get("content_ideas", [])[:5]],
+                ad_copies=[AdCopy(**copy) for copy in result.get("ad_copies", [])[:3]],
+                cta_suggestions=result.get("cta_suggestions", [])
+            )
     except json.JSONDecodeError:
         # Fallback response
         return CampaignResponse(
@@ -446,7 +620,8 @@ def get_financial_data(company_name: str) -> dict:
     
     try:
         ticker = yf.Ticker(ticker_symbol)
-        info = ticker.info
+        with trace_span("yfinance.info", ticker=ticker_symbol):
+            info = ticker.info
         
         price = info.get('regularMarketPrice') or info.get('currentPrice', 'N/A')
         market_cap = info.get('marketCap', 0)
@@ -506,8 +681,9 @@ def get_news_headlines(company_name: str) -> List[dict]:
     try:
         if NEWS_API_KEY:
             url = f"https://newsapi.org/v2/everything?q={company_name}&sortBy=publishedAt&pageSize=3&apiKey={NEWS_API_KEY}"
-            response = requests.get(url, timeout=10)
-            articles = response.json().get('articles', [])[:3]
+            with trace_span("newsapi.everything", query=company_name):
+                response = requests.get(url, timeout=10)
+                articles = response.json().get('articles', [])[:3]
             return [{"headline": a.get('title', ''), "source": a.get('source', {}).get('name', '')} for a in articles]
     except:
         pass
@@ -530,14 +706,15 @@ async def get_company_intel(request: CompanyIntelRequest):
     financial_data = get_financial_data(company_name)
     headlines = get_news_headlines(company_name)
     
-    headlines_text = "\n".join([f"- {h['headline']}" for h in headlines])
+    with trace_span("build_prompt"):
+        headlines_text = "\n".join([f"- {h['headline']}" for h in headlines])
     
-    # Build prompt with optional product fit section
-    product_fit_section = ""
-    product_fit_json = ""
-    extra_instruction = ""
-    if product_context and len(product_context.strip()) >= 3:
-        product_fit_section = f"""
+        # Build prompt with optional product fit section
+        product_fit_section = ""
+        product_fit_json = ""
+        extra_instruction = ""
+        if product_context and len(product_context.strip()) >= 3:
+            product_fit_section = f"""
 
 PRODUCT YOU ARE SELLING: {product_context}
 
@@ -560,23 +737,23 @@ STRICT SCORING RULES:
 - 1-2: POOR - No logical connection between product and company
 
 IMPORTANT: If the product description is vague or doesn't clearly relate to {company_name}'s business, give a LOWER score (3-5). Be skeptical, not optimistic."""
-        product_fit_json = """,
+            product_fit_json = """,
     "product_fit": {
         "score": 6,
         "verdict": "Moderate Fit",
         "reasons": ["Reason based on industry analysis", "Reason based on business relevance", "Reason based on timing/news"],
         "suggested_angle": "Specific pitch strategy if pursuing"
     }"""
-        extra_instruction = "\n6. CRITICAL Product Fit analysis - be skeptical and give an honest score (1-10)"
-    elif product_context:
-        # Product description too short
-        product_fit_section = ""
-        product_fit_json = ""
-        extra_instruction = ""
-        product_context = None  # Reset to skip fit analysis
+            extra_instruction = "\n6. CRITICAL Product Fit analysis - be skeptical and give an honest score (1-10)"
+        elif product_context:
+            # Product description too short
+            product_fit_section = ""
+            product_fit_json = ""
+            extra_instruction = ""
+            product_context = None  # Reset to skip fit analysis
     
-    # Build comprehensive company profile from real data
-    company_profile = f"""
+        # Build comprehensive company profile from real data
+        company_profile = f"""
 COMPANY PROFILE (Real-time data from Yahoo Finance):
 - Name: {company_name}
 - Industry: {financial_data.get('industry', financial_data['sector'])}
@@ -593,7 +770,7 @@ BUSINESS DESCRIPTION:
 {financial_data.get('business_summary', 'No description available')}
 """
 
-    prompt = f"""You are a Senior Sales Director analyzing this company for a sales approach.
+        prompt = f"""You are a Senior Sales Director analyzing this company for a sales approach.
 {company_profile}
 
 RECENT NEWS (from News API):
@@ -619,36 +796,37 @@ RESPOND IN EXACT JSON:
         response_text = generate_with_groq(prompt, 1500 if product_context else 1000)
         result = parse_json_response(response_text)
         
-        news_items = [NewsItem(headline=n.get("headline", ""), sentiment=n.get("sentiment", "neutral"), 
-                               source=next((h["source"] for h in headlines if h["headline"] == n.get("headline")), None))
-                     for n in result.get("news_sentiments", [])]
+        with trace_span("build_response", model="CompanyIntelResponse"):
+            news_items = [NewsItem(headline=n.get("headline", ""), sentiment=n.get("sentiment", "neutral"), 
+                                   source=next((h["source"] for h in headlines if h["headline"] == n.get("headline")), None))
+                         for n in result.get("news_sentiments", [])]
         
-        if not news_items:
-            news_items = [NewsItem(headline=h["headline"], sentiment="neutral", source=h.get("source")) for h in headlines]
+            if not news_items:
+                news_items = [NewsItem(headline=h["headline"], sentiment="neutral", source=h.get("source")) for h in headlines]
         
-        # Parse product fit if provided
-        product_fit = None
-        if product_context and "product_fit" in result:
-            pf = result["product_fit"]
-            product_fit = ProductFit(
-                score=int(pf.get("score", 5)),
-                verdict=pf.get("verdict", "Moderate Fit"),
-                reasons=pf.get("reasons", []),
-                suggested_angle=pf.get("suggested_angle", "")
-            )
+            # Parse product fit if provided
+            product_fit = None
+            if product_context and "product_fit" in result:
+                pf = result["product_fit"]
+                product_fit = ProductFit(
+                    score=int(pf.get("score", 5)),
+                    verdict=pf.get("verdict", "Moderate Fit"),
+                    reasons=pf.get("reasons", []),
+                    suggested_angle=pf.get("suggested_angle", "")
+                )
         
-        return CompanyIntelResponse(
-            company_name=company_name.title(),
-            financial_health=FinancialHealth(**financial_data),
-            news=news_items,
-            strategy=Strategy(
-                approach=result.get("approach", "scaling_growth"),
-                pitch_points=result.get("pitch_points", []),
-                reasoning=result.get("reasoning", "")
-            ),
-            cold_email=result.get("cold_email", ""),
-            product_fit=product_fit
-        )
+            return CompanyIntelResponse(
+                company_name=company_name.title(),
+                financial_health=FinancialHealth(**financial_data),
+                news=news_items,
+                strategy=Strategy(
+                    approach=result.get("approach", "scaling_growth"),
+                    pitch_points=result.get("pitch_points", []),
+                    reasoning=result.get("reasoning", "")
+                ),
+                cold_email=result.get("cold_email", ""),
+                product_fit=product_fit
+            )
     except Exception as e:
         import traceback
         print(f"ERROR in /intel endpoint: {e}")
@@ -667,5 +845,47 @@ RESPOND IN EXACT JSON:
         )
 
 
+# ==================== ADMIN: REQUEST TRACES ====================
+
+def require_admin(token: Optional[str]):
+    """Reject admin requests unless ADMIN_TOKEN is configured and matches"""
+    if not ADMIN_TOKEN or not token or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin access denied")
+
+@app.get("/admin/traces")
+async def list_traces(x_admin_token: Optional[str] = Header(None)):
+    """List recently captured request traces, newest first"""
+    require_admin(x_admin_token)
+    with _traces_lock:
+        traces = list(_traces)
+    return [trace.summary() for trace in reversed(traces)]
+
+@app.get("/admin/traces/{trace_id}")
+async def get_trace(trace_id: str, format: str = "json", source: str = "spans",
+                    x_admin_token: Optional[str] = Header(None)):
+    """Return one trace as JSON, or as collapsed stacks (format=folded) for flamegraph tools"""
+    require_admin(x_admin_token)
+    with _traces_lock:
+        trace = next((t for t in _traces if t.trace_id == trace_id), None)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    
+    if format == "json":
+        return trace.to_dict()
+    if format != "folded":
+        raise HTTPException(status_code=400, detail="format must be 'json' or 'folded'")
+    
+    if source == "spans":
+        # Values are span self-times in microseconds
+        lines = trace.root.folded()
+    elif source == "cpu":
+        if trace.cpu_samples is None:
+            raise HTTPException(status_code=400, detail="No CPU profile was captured for this trace")
+        lines = [f"{stack} {count}" for stack, count in trace.cpu_samples.most_common()]
+    else:
+        raise HTTPException(status_code=400, detail="source must be 'spans' or 'cpu'")
+    return PlainTextResponse("\n".join(lines) + "\n")
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file